@@ -1,15 +1,21 @@
 """
 One-time authentication script to generate a session string.
-Run this once to get your SESSION_SECRET, then update config.py.
+Run this once to get your SESSION_SECRET, then set it in your environment or .env.
 """
 import asyncio
-from telethon import TelegramClient
-from telethon.sessions import StringSession
+import sys
 
-API_ID = 25458518
-API_HASH = "e0a73353c37306f9fa68b1e2a4ba6eab"
+from config import API_ID, API_HASH
 
 async def main():
+    # Imported here so importing this module doesn't pay Telethon's import cost
+    from telethon import TelegramClient
+    from telethon.sessions import StringSession
+    
+    if not API_ID or not API_HASH:
+        print("API_ID and API_HASH must be set in environment variables or .env")
+        sys.exit(1)
+    
     print("=" * 50)
     print("Telegram Session Generator")
     print("=" * 50)
@@ -25,11 +31,11 @@ async def main():
     me = await client.get_me()
     print(f"\nLogged in as: {me.first_name} (@{me.username}) [ID: {me.id}]")
     print("\n" + "=" * 50)
-    print("SESSION STRING (update this in config.py):")
+    print("SESSION STRING (set this as SESSION_SECRET):")
     print("=" * 50)
     print(f"\n{session_string}\n")
     print("=" * 50)
-    print("\nCopy the session string above and update SESSION_SECRET in config.py.")
+    print("\nCopy the session string above and set it as SESSION_SECRET in your environment or .env.")
     print("Then the userbot will start automatically without requiring login.\n")
     
     await client.disconnect()
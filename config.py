@@ -1,23 +1,47 @@
 """
 Configuration module for Telegram Userbot.
-Hardcoded settings for Replit deployment.
+Secrets and tunables are read from environment variables (or a .env file).
 """
 import os
 
-API_ID = 25458518
-API_HASH = "e0a73353c37306f9fa68b1e2a4ba6eab"
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def _env_number(name: str, default, cast=int):
+    """Read a numeric environment variable, exiting with a clear error if malformed."""
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        raise SystemExit(f"{name} must be a number, got {value!r}")
+
+
+API_ID = _env_number("API_ID", 0)
+API_HASH = os.getenv("API_HASH", "")
 SESSION_NAME = "userbot_session"
-SESSION_SECRET = "1BVtsOMcBu3v72ZykT7FJhZlimKwwcWue89IJJOeosJ1Mm5-IQzDDwJN6u4HemmG3mdvIu5OAJm74RHog8l77GcBjgS9Z8GtfXd5lAE1PFYQyQ6NF2n_ubqH8vWhqqCYc-3rnoE0TBjpntdHIXWIzeGSm9_y-sYyWfvjBeNPaFEZmPSvfh4ybYS_gXRYRtchz6mXRpDHpsf10DcEIvJgMbmauMx4DHBt90d5DX2uJPmivJA-npd-zZSVRmwD_Ysnu4CjwDBlFdmBfbyQPD59dFoMwdQedc-EnKJh4uYrWxxyCP5ttC5l8UQce04Mg0kNqmK3wuoADf7Ja5mQzlpVpWNO3LGQ_5FE="
-OWNER_ID = 8116724251
+SESSION_SECRET = os.getenv("SESSION_SECRET", "")
+OWNER_ID = _env_number("OWNER_ID", 0)
 
-TIMEOUT_SECONDS = 60
-REPLY_IDLE_SECONDS = 2.0
-EDIT_DEBOUNCE_SECONDS = 1.5
-CLEANUP_HOURS = 24
+TIMEOUT_SECONDS = _env_number("TIMEOUT_SECONDS", 60)
+REPLY_IDLE_SECONDS = _env_number("REPLY_IDLE_SECONDS", 2.0, float)
+EDIT_DEBOUNCE_SECONDS = _env_number("EDIT_DEBOUNCE_SECONDS", 1.5, float)
+CLEANUP_HOURS = _env_number("CLEANUP_HOURS", 24)
+FLOOD_WAIT_RETRIES = 3
+MAPPINGS_FLUSH_SECONDS = 0.5
+REQUESTS_FLUSH_SECONDS = 0.5
+CONFIG_FLUSH_SECONDS = 0.5
+FLUSH_RETRY_MAX_SECONDS = 60
+MAPPINGS_LOG_MAX_RECORDS = 1000
+DURABLE_WRITES = True
 
 DATA_DIR = "data"
 CONFIG_FILE = os.path.join(DATA_DIR, "config.json")
 MAPPINGS_FILE = os.path.join(DATA_DIR, "mappings.json")
+MAPPINGS_LOG_FILE = os.path.join(DATA_DIR, "mappings.log")
 REQUESTS_FILE = os.path.join(DATA_DIR, "requests.json")
 
 COMMAND_PREFIX = "/strco"
@@ -12,7 +12,7 @@ from telethon.sessions import StringSession
 
 from config import API_ID, API_HASH, SESSION_NAME, SESSION_SECRET, OWNER_ID, COMMAND_PREFIX
 from storage import ConfigStorage, MappingsStorage, RequestsStorage
-from relay import process_relay_request, handle_edit
+from relay import process_relay_request, handle_edit, get_cached_entity, prune_edit_debounce
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,8 +21,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Optional faster event loop; must be set before the client is created
+try:
+    import uvloop
+    asyncio.set_event_loop(uvloop.new_event_loop())
+    logger.info("Using uvloop event loop")
+except ImportError:
+    pass
+
 if not API_ID or not API_HASH:
-    logger.error("API_ID and API_HASH must be set in environment variables")
+    logger.error("API_ID and API_HASH must be set in environment variables or .env")
     sys.exit(1)
 
 if not OWNER_ID:
@@ -35,11 +43,17 @@ else:
     logger.info("Using file-based session (requires interactive login)")
     client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
 
-_tracked_bot_chats: set = set()
+_tracked_bot_chats: dict = {}
 _user_cooldowns: dict = {}
+_background_tasks: set = set()
 COOLDOWN_SECONDS = 5
 
 
+def _raw_text(message: Message) -> str:
+    """Return the raw message text without rendering entities to markdown."""
+    return message.message or ""
+
+
 def parse_command(text: str) -> tuple:
     """Parse command and arguments from message text."""
     if not text:
@@ -71,29 +85,20 @@ async def process_strco_command(event, message: Message, sender_id: int):
     
     logger.info(f"Processing /strco relay from user {sender_id} in chat {event.chat_id}")
     
-    target_bot = await ConfigStorage.get_chat_bot(event.chat_id)
-    if target_bot:
-        try:
-            bot_entity = await client.get_entity(target_bot)
-            _tracked_bot_chats.add(bot_entity.id)
-        except Exception as e:
-            logger.warning(f"Could not track bot chat: {e}")
+    async def track_bot_chat():
+        target_bot = await ConfigStorage.get_chat_bot(event.chat_id)
+        if target_bot:
+            try:
+                bot_entity = await get_cached_entity(client, target_bot)
+                _tracked_bot_chats[bot_entity.id] = now
+            except Exception as e:
+                logger.warning(f"Could not track bot chat: {e}")
     
-    origin_chat = await event.get_chat()
+    _, origin_chat = await asyncio.gather(track_bot_chat(), event.get_chat())
     await process_relay_request(client, message, event.chat_id, origin_chat)
 
 
-@client.on(events.NewMessage(outgoing=True))
-async def handle_outgoing(event: events.NewMessage.Event):
-    """Handle outgoing messages (from owner account)."""
-    message: Message = event.message
-    sender_id = (await client.get_me()).id
-    
-    text = message.text or message.message or ""
-    cmd, args = parse_command(text)
-    
-    if cmd == "/strcohelp":
-        help_text = """**Telegram Relay Userbot Commands**
+HELP_TEXT = """**Telegram Relay Userbot Commands**
 
 **Relay:**
 `/strco <message>` - Relay message to target bot
@@ -109,74 +114,113 @@ async def handle_outgoing(event: events.NewMessage.Event):
 `/allowed` - List allowed users
 
 `/strcohelp` - Show this help"""
-        await event.respond(help_text)
+
+
+async def _cmd_help(event, args: str, sender_id: int):
+    """Handle /strcohelp."""
+    await event.respond(HELP_TEXT)
+
+
+async def _cmd_setstrco(event, args: str, sender_id: int):
+    """Handle /setstrco @BotUsername."""
+    if not await is_owner(sender_id):
         return
-    
-    if cmd == "/setstrco":
-        if not await is_owner(sender_id):
-            return
-        bot_username = args.strip()
-        if not bot_username or not bot_username.startswith("@"):
-            await event.respond("Usage: /setstrco @BotUsername")
-            return
-        await ConfigStorage.set_chat_bot(event.chat_id, bot_username)
-        await event.respond(f"Target bot for this chat set to: {bot_username}")
+    bot_username = args.strip()
+    if not bot_username or not bot_username.startswith("@"):
+        await event.respond("Usage: /setstrco @BotUsername")
         return
-    
-    if cmd == "/setstrcoglobal":
-        if not await is_owner(sender_id):
-            return
-        bot_username = args.strip()
-        if not bot_username or not bot_username.startswith("@"):
-            await event.respond("Usage: /setstrcoglobal @BotUsername")
-            return
-        await ConfigStorage.set_global_bot(bot_username)
-        await event.respond(f"Global target bot set to: {bot_username}")
+    await ConfigStorage.set_chat_bot(event.chat_id, bot_username)
+    await event.respond(f"Target bot for this chat set to: {bot_username}")
+
+
+async def _cmd_setstrcoglobal(event, args: str, sender_id: int):
+    """Handle /setstrcoglobal @BotUsername."""
+    if not await is_owner(sender_id):
         return
-    
-    if cmd == "/strcobot":
-        chat_bot = await ConfigStorage.get_chat_bot(event.chat_id)
-        if chat_bot:
-            await event.respond(f"Current target bot: {chat_bot}")
+    bot_username = args.strip()
+    if not bot_username or not bot_username.startswith("@"):
+        await event.respond("Usage: /setstrcoglobal @BotUsername")
+        return
+    await ConfigStorage.set_global_bot(bot_username)
+    await event.respond(f"Global target bot set to: {bot_username}")
+
+
+async def _cmd_strcobot(event, args: str, sender_id: int):
+    """Handle /strcobot."""
+    chat_bot = await ConfigStorage.get_chat_bot(event.chat_id)
+    if chat_bot:
+        await event.respond(f"Current target bot: {chat_bot}")
+    else:
+        await event.respond("No target bot configured. Use /setstrco or /setstrcoglobal")
+
+
+async def _cmd_allow(event, args: str, sender_id: int):
+    """Handle /allow <user_id>."""
+    if not await is_owner(sender_id):
+        await event.respond("Not allowed.")
+        return
+    try:
+        user_id = int(args.strip())
+        await ConfigStorage.allow_user(user_id)
+        await event.respond(f"User {user_id} is now allowed to use /strco")
+    except ValueError:
+        await event.respond("Usage: /allow <user_id>")
+
+
+async def _cmd_disallow(event, args: str, sender_id: int):
+    """Handle /disallow <user_id>."""
+    if not await is_owner(sender_id):
+        await event.respond("Not allowed.")
+        return
+    try:
+        user_id = int(args.strip())
+        result = await ConfigStorage.disallow_user(user_id)
+        if result:
+            await event.respond(f"User {user_id} access revoked")
         else:
-            await event.respond("No target bot configured. Use /setstrco or /setstrcoglobal")
+            await event.respond("Cannot remove owner or user not in list")
+    except ValueError:
+        await event.respond("Usage: /disallow <user_id>")
+
+
+async def _cmd_allowed(event, args: str, sender_id: int):
+    """Handle /allowed."""
+    if not await is_owner(sender_id):
+        await event.respond("Not allowed.")
         return
+    allowed = await ConfigStorage.get_allowed_users()
+    owner = await ConfigStorage.get_owner_id()
+    users_str = "\n".join([f"- {uid}" + (" (owner)" if uid == owner else "") for uid in allowed])
+    await event.respond(f"**Allowed Users:**\n{users_str}" if users_str else "No users allowed")
+
+
+_COMMANDS = {
+    "/strcohelp": _cmd_help,
+    "/setstrco": _cmd_setstrco,
+    "/setstrcoglobal": _cmd_setstrcoglobal,
+    "/strcobot": _cmd_strcobot,
+    "/allow": _cmd_allow,
+    "/disallow": _cmd_disallow,
+    "/allowed": _cmd_allowed,
+}
+
+
+@client.on(events.NewMessage(outgoing=True))
+async def handle_outgoing(event: events.NewMessage.Event):
+    """Handle outgoing messages (from owner account)."""
+    message: Message = event.message
     
-    if cmd == "/allow":
-        if not await is_owner(sender_id):
-            await event.respond("Not allowed.")
-            return
-        try:
-            user_id = int(args.strip())
-            await ConfigStorage.allow_user(user_id)
-            await event.respond(f"User {user_id} is now allowed to use /strco")
-        except ValueError:
-            await event.respond("Usage: /allow <user_id>")
+    text = _raw_text(message)
+    # Most outgoing messages are not commands; bail out before any parsing or RPC
+    if not text or text[0] != "/":
         return
     
-    if cmd == "/disallow":
-        if not await is_owner(sender_id):
-            await event.respond("Not allowed.")
-            return
-        try:
-            user_id = int(args.strip())
-            result = await ConfigStorage.disallow_user(user_id)
-            if result:
-                await event.respond(f"User {user_id} access revoked")
-            else:
-                await event.respond("Cannot remove owner or user not in list")
-        except ValueError:
-            await event.respond("Usage: /disallow <user_id>")
-        return
+    cmd, args = parse_command(text)
+    sender_id = (await client.get_me()).id
     
-    if cmd == "/allowed":
-        if not await is_owner(sender_id):
-            await event.respond("Not allowed.")
-            return
-        allowed = await ConfigStorage.get_allowed_users()
-        owner = await ConfigStorage.get_owner_id()
-        users_str = "\n".join([f"- {uid}" + (" (owner)" if uid == owner else "") for uid in allowed])
-        await event.respond(f"**Allowed Users:**\n{users_str}" if users_str else "No users allowed")
+    handler = _COMMANDS.get(cmd)
+    if handler:
+        await handler(event, args, sender_id)
         return
     
     if text.startswith(COMMAND_PREFIX):
@@ -193,13 +237,13 @@ async def handle_incoming(event: events.NewMessage.Event):
     
     sender_id = event.sender_id
     
-    owner_id = await ConfigStorage.get_owner_id()
-    if sender_id == owner_id:
+    # Cheap text check first: this fires for every incoming message in every chat
+    text = _raw_text(message)
+    if not text.startswith(COMMAND_PREFIX):
         return
     
-    text = message.text or message.message or ""
-    
-    if not text.startswith(COMMAND_PREFIX):
+    owner_id = await ConfigStorage.get_owner_id()
+    if sender_id == owner_id:
         return
     
     await process_strco_command(event, message, sender_id)
@@ -223,36 +267,88 @@ async def handle_message_edited(event: events.MessageEdited.Event):
     await handle_edit(client, message, chat_id, debounce)
 
 
+def prune_runtime_state(settings: dict):
+    """Drop expired cooldowns, debounce entries and tracked bot chats."""
+    now = time_module.time()
+    
+    expired = [k for k, ts in _user_cooldowns.items() if now - ts >= COOLDOWN_SECONDS]
+    for k in expired:
+        del _user_cooldowns[k]
+    
+    # Keep tracking bots for as long as their mappings can still be edited
+    track_seconds = settings.get("cleanup_hours", 24) * 3600
+    untracked = [k for k, ts in _tracked_bot_chats.items() if now - ts >= track_seconds]
+    for k in untracked:
+        del _tracked_bot_chats[k]
+    
+    debounce = settings.get("edit_debounce", 1.5)
+    pruned = prune_edit_debounce(max(debounce * 4, 60))
+    
+    logger.info(
+        f"Pruned {len(expired)} cooldowns, {len(untracked)} tracked bots, "
+        f"{pruned} debounce entries"
+    )
+
+
+async def run_cleanup() -> dict:
+    """Clean up old mappings and stale requests concurrently. Returns settings used."""
+    settings = await ConfigStorage.get_settings()
+    cleanup_hours = settings.get("cleanup_hours", 24)
+    timeout = settings.get("timeout", 60)
+    
+    # Mappings and requests live in separate files, so clean them in parallel
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(MappingsStorage.cleanup_old(cleanup_hours))
+        tg.create_task(RequestsStorage.cleanup_stale(timeout * 2))
+    return settings
+
+
 async def periodic_cleanup():
     """Periodically clean up old mappings and stale requests."""
     while True:
         await asyncio.sleep(3600)
         try:
-            settings = await ConfigStorage.get_settings()
-            cleanup_hours = settings.get("cleanup_hours", 24)
-            timeout = settings.get("timeout", 60)
-            
-            await MappingsStorage.cleanup_old(cleanup_hours)
-            await RequestsStorage.cleanup_stale(timeout * 2)
+            settings = await run_cleanup()
+            prune_runtime_state(settings)
             
             logger.info("Periodic cleanup completed")
         except Exception as e:
-            logger.error(f"Cleanup error: {e}")
+            logger.error(f"Cleanup error: {e!r}")
 
 
 async def startup_cleanup():
     """Run cleanup on startup."""
     try:
-        settings = await ConfigStorage.get_settings()
-        cleanup_hours = settings.get("cleanup_hours", 24)
-        timeout = settings.get("timeout", 60)
-        
-        await MappingsStorage.cleanup_old(cleanup_hours)
-        await RequestsStorage.cleanup_stale(timeout * 2)
+        await run_cleanup()
         
         logger.info("Startup cleanup completed")
     except Exception as e:
-        logger.error(f"Startup cleanup error: {e}")
+        logger.error(f"Startup cleanup error: {e!r}")
+
+
+async def flush_storage():
+    """Write out any debounced storage changes."""
+    await ConfigStorage.flush_now()
+    await MappingsStorage.flush_now()
+    await RequestsStorage.flush_now()
+
+
+def _log_if_failed(task: asyncio.Task):
+    """Done callback that logs background task failures instead of dropping them."""
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc:
+        logger.error(f"Background task {task.get_name()} failed: {exc!r}")
+
+
+def start_background_task(coro, name: str) -> asyncio.Task:
+    """Start a long-running task, keeping a reference and logging failures."""
+    task = asyncio.create_task(coro, name=name)
+    task.add_done_callback(_log_if_failed)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 
 async def main():
@@ -266,12 +362,14 @@ async def main():
     
     await startup_cleanup()
     
-    asyncio.create_task(periodic_cleanup())
+    start_background_task(periodic_cleanup(), "periodic_cleanup")
     
     logger.info("Userbot is running. Use /strcohelp for commands.")
     logger.info(f"Owner ID: {OWNER_ID}")
     
     await client.run_until_disconnected()
+    
+    await flush_storage()
 
 
 if __name__ == "__main__":
@@ -279,6 +377,7 @@ if __name__ == "__main__":
         client.loop.run_until_complete(main())
     except KeyboardInterrupt:
         logger.info("Userbot stopped by user")
+        client.loop.run_until_complete(flush_storage())
     except Exception as e:
         logger.error(f"Fatal error: {e}")
         sys.exit(1)
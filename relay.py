@@ -5,31 +5,58 @@ import asyncio
 import time
 import hashlib
 import logging
-from typing import Optional, List
-from telethon import TelegramClient
+from typing import Optional, List, Set
+from telethon import TelegramClient, events
+from telethon.helpers import generate_random_long
+from telethon.tl import functions
 from telethon.tl.types import (
     Message, MessageMediaPhoto, MessageMediaDocument,
-    DocumentAttributeVideo, DocumentAttributeAudio
+    DocumentAttributeVideo, DocumentAttributeAudio,
+    UpdateMessageID, UpdateShortSentMessage
 )
-from telethon.errors import FloodWaitError, RPCError
+from telethon.errors import FloodWaitError, MultiError, PeerIdInvalidError, RPCError
 
+from config import FLOOD_WAIT_RETRIES
 from storage import ConfigStorage, MappingsStorage, RequestsStorage
 
 logger = logging.getLogger(__name__)
 
 _edit_debounce: dict = {}
+_entity_cache: dict = {}
+
+ALBUM_MEDIA_TYPES = ("photo", "video")
+BATCH_MAX_ITEMS = 10
+
+
+async def get_cached_entity(client: TelegramClient, key, allow_input: bool = False):
+    """
+    Resolve an entity once and reuse it for later lookups.
+    With allow_input, falls back to the input entity if the full one can't be fetched.
+    """
+    entity = _entity_cache.get(key)
+    if entity is not None:
+        return entity
+    try:
+        entity = await client.get_entity(key)
+    except Exception:
+        if not allow_input:
+            raise
+        entity = await client.get_input_entity(key)
+    _entity_cache[key] = entity
+    return entity
+
+
+def invalidate_entity(key):
+    """Drop a cached entity so the next lookup resolves it again."""
+    _entity_cache.pop(key, None)
 
 
 def get_content_hash(message: Message) -> str:
     """Generate hash of message content for change detection."""
-    content = ""
-    if message.text:
-        content = message.text
-    if message.message:
-        content += message.message
+    content = message.message or ""
     if message.media:
-        content += str(type(message.media).__name__)
-    return hashlib.md5(content.encode()).hexdigest()[:16]
+        content += type(message.media).__name__
+    return hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
 
 
 def is_media_message(message: Message) -> bool:
@@ -57,6 +84,21 @@ def get_media_type(message: Message) -> str:
     return "media"
 
 
+async def with_flood_retry(call, action: str):
+    """
+    Await call() and retry after a FloodWaitError, up to FLOOD_WAIT_RETRIES attempts.
+    The last FloodWaitError is re-raised once the retries are used up.
+    """
+    for attempt in range(1, FLOOD_WAIT_RETRIES + 1):
+        try:
+            return await call()
+        except FloodWaitError as e:
+            if attempt == FLOOD_WAIT_RETRIES:
+                raise
+            logger.warning(f"FloodWait {action}: sleeping {e.seconds}s (attempt {attempt})")
+            await asyncio.sleep(e.seconds)
+
+
 async def relay_message(client: TelegramClient, origin_message: Message, 
                         target_bot: str) -> Optional[Message]:
     """
@@ -64,27 +106,30 @@ async def relay_message(client: TelegramClient, origin_message: Message,
     Returns the sent message or None on failure.
     """
     try:
-        bot_entity = await client.get_entity(target_bot)
+        bot_entity = await get_cached_entity(client, target_bot)
         
         if is_media_message(origin_message):
-            sent = await client.send_file(
+            sent = await with_flood_retry(lambda: client.send_file(
                 bot_entity,
                 origin_message.media,
                 caption=origin_message.message or ""
-            )
+            ), "relaying")
         else:
-            sent = await client.send_message(
+            sent = await with_flood_retry(lambda: client.send_message(
                 bot_entity,
                 origin_message.text or origin_message.message
-            )
+            ), "relaying")
         
         logger.info(f"Relayed message to {target_bot}, msg_id: {sent.id}")
         return sent
         
     except FloodWaitError as e:
-        logger.warning(f"FloodWait: sleeping {e.seconds}s")
-        await asyncio.sleep(e.seconds)
-        return await relay_message(client, origin_message, target_bot)
+        logger.error(f"Giving up relaying message after repeated FloodWait: {e}")
+        return None
+    except PeerIdInvalidError as e:
+        invalidate_entity(target_bot)
+        logger.error(f"Invalid peer for {target_bot}, entity cache cleared: {e}")
+        return None
     except RPCError as e:
         logger.error(f"RPC error relaying message: {e}")
         return None
@@ -93,111 +138,224 @@ async def relay_message(client: TelegramClient, origin_message: Message,
         return None
 
 
-async def collect_bot_replies(client: TelegramClient, bot_entity, 
-                              sent_msg_id: int, settings: dict) -> List[Message]:
+async def collect_bot_replies(queue: asyncio.Queue, sent_msg_id: int,
+                              settings: dict) -> List[Message]:
     """
     Collect bot replies using idle-window logic.
-    Waits for replies after sent_msg_id until idle timeout or hard timeout.
+    Consumes messages pushed onto queue by a NewMessage handler and waits for
+    replies after sent_msg_id until idle timeout or hard timeout.
     """
     timeout = settings.get("timeout", 60)
     idle_timeout = settings.get("reply_idle", 2)
     
-    start_time = time.time()
     replies: List[Message] = []
-    last_reply_time = None
-    first_reply_received = False
+    seen_ids: Set[int] = set()
     
     logger.info(f"Collecting replies for msg {sent_msg_id}, timeout={timeout}s, idle={idle_timeout}s")
     
-    while True:
-        elapsed = time.time() - start_time
-        
-        if elapsed >= timeout:
-            logger.info("Hard timeout reached")
-            break
-        
-        if first_reply_received and last_reply_time:
-            idle_elapsed = time.time() - last_reply_time
-            if idle_elapsed >= idle_timeout:
+    async def _collect():
+        while True:
+            # Wait indefinitely for the first reply; the hard timeout bounds it
+            wait = idle_timeout if replies else None
+            try:
+                msg = await asyncio.wait_for(queue.get(), timeout=wait)
+            except asyncio.TimeoutError:
                 logger.info("Idle timeout reached, collection complete")
-                break
-        
-        try:
-            messages = await client.get_messages(bot_entity, limit=10)
+                return
             
-            for msg in messages:
-                if msg.id <= sent_msg_id:
-                    continue
-                if msg.out:
-                    continue
-                if any(r.id == msg.id for r in replies):
-                    continue
-                
-                replies.append(msg)
-                last_reply_time = time.time()
-                first_reply_received = True
-                logger.info(f"Collected reply msg_id: {msg.id}")
+            if msg.id <= sent_msg_id or msg.id in seen_ids:
+                continue
             
-            await asyncio.sleep(0.3)
-            
-        except FloodWaitError as e:
-            logger.warning(f"FloodWait during collection: {e.seconds}s")
-            await asyncio.sleep(e.seconds)
-        except Exception as e:
-            logger.error(f"Error collecting replies: {e}")
-            await asyncio.sleep(0.5)
+            seen_ids.add(msg.id)
+            replies.append(msg)
+            logger.info(f"Collected reply msg_id: {msg.id}")
+    
+    try:
+        await asyncio.wait_for(_collect(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.info("Hard timeout reached")
     
     replies.sort(key=lambda m: m.id)
     return replies
 
 
-async def mirror_message(client: TelegramClient, origin_chat_id: int,
-                         bot_message: Message, bot_chat_id: int, origin_entity=None) -> Optional[int]:
+async def mirror_message(client: TelegramClient, origin_entity,
+                         bot_message: Message) -> Optional[Message]:
     """
-    Mirror a bot's reply message to the origin chat.
-    Returns the mirrored message ID.
+    Mirror a single bot reply to the origin chat.
+    Returns the mirrored message or None on failure.
     """
     try:
-        if origin_entity is None:
-            try:
-                origin_entity = await client.get_entity(origin_chat_id)
-            except Exception:
-                origin_entity = await client.get_input_entity(origin_chat_id)
-        
         if is_media_message(bot_message):
-            mirrored = await client.send_file(
+            return await with_flood_retry(lambda: client.send_file(
                 origin_entity,
                 bot_message.media,
                 caption=bot_message.message or ""
+            ), "mirroring")
+        return await with_flood_retry(lambda: client.send_message(
+            origin_entity,
+            bot_message.text or bot_message.message
+        ), "mirroring")
+        
+    except Exception as e:
+        logger.error(f"Error mirroring message: {e}")
+        return None
+
+
+async def mirror_album(client: TelegramClient, origin_entity,
+                       bot_messages: List[Message]) -> List[Optional[Message]]:
+    """
+    Mirror consecutive photo/video replies as one album send.
+    Falls back to individual sends only if the album send itself fails.
+    """
+    try:
+        mirrored = await with_flood_retry(lambda: client.send_file(
+            origin_entity,
+            [m.media for m in bot_messages],
+            caption=[m.message or "" for m in bot_messages]
+        ), "mirroring album")
+        if not isinstance(mirrored, list):
+            mirrored = [mirrored]
+        if len(mirrored) != len(bot_messages):
+            # The album is already posted; resending would duplicate it
+            logger.warning(
+                f"Album send returned {len(mirrored)} messages for "
+                f"{len(bot_messages)} items, mapping by position"
             )
-            msg_type = get_media_type(bot_message)
-        else:
-            mirrored = await client.send_message(
-                origin_entity,
-                bot_message.text or bot_message.message
+            mirrored = (mirrored + [None] * len(bot_messages))[:len(bot_messages)]
+        return mirrored
+        
+    except FloodWaitError as e:
+        logger.error(f"Giving up mirroring album after repeated FloodWait: {e}")
+        return [None] * len(bot_messages)
+    except Exception as e:
+        logger.error(f"Error mirroring album, sending individually: {e}")
+    
+    return [await mirror_message(client, origin_entity, m) for m in bot_messages]
+
+
+async def mirror_text_run(client: TelegramClient, origin_entity,
+                          bot_messages: List[Message]) -> List[Optional[int]]:
+    """
+    Mirror consecutive text replies as one ordered batch of requests.
+    Telethon chains ordered requests with invokeAfterMsg, so the server
+    keeps reply order without a round-trip per message.
+    Returns the mirrored message IDs (None for failed sends).
+    """
+    try:
+        peer = await client.get_input_entity(origin_entity)
+        requests = [
+            functions.messages.SendMessageRequest(
+                peer=peer,
+                message=m.message,
+                entities=m.entities,
+                random_id=generate_random_long()
             )
-            msg_type = "text"
+            for m in bot_messages
+        ]
+        try:
+            results = await with_flood_retry(
+                lambda: client(requests, ordered=True), "mirroring text batch"
+            )
+        except MultiError as e:
+            logger.error(f"Error mirroring part of text batch: {e}")
+            results = e.results
         
-        content_hash = get_content_hash(bot_message)
-        await MappingsStorage.add_mapping(
-            bot_chat_id=bot_chat_id,
-            bot_msg_id=bot_message.id,
-            origin_chat_id=origin_chat_id,
-            mirrored_msg_id=mirrored.id,
-            msg_type=msg_type,
-            content_hash=content_hash
-        )
+        if not isinstance(results, list) or len(results) != len(requests):
+            logger.warning("Text batch returned unexpected results, mappings skipped")
+            return [None] * len(bot_messages)
         
-        logger.info(f"Mirrored msg {bot_message.id} -> {mirrored.id} in chat {origin_chat_id}")
-        return mirrored.id
+        mirrored_ids = [
+            _sent_message_id(request, result) if result is not None else None
+            for request, result in zip(requests, results)
+        ]
+        # Resend only the messages the server rejected
+        for i, (bot_message, result) in enumerate(zip(bot_messages, results)):
+            if result is None:
+                sent = await mirror_message(client, origin_entity, bot_message)
+                mirrored_ids[i] = sent.id if sent else None
+        return mirrored_ids
         
     except FloodWaitError as e:
-        logger.warning(f"FloodWait mirroring: {e.seconds}s")
-        await asyncio.sleep(e.seconds)
-        return await mirror_message(client, origin_chat_id, bot_message, bot_chat_id)
+        logger.error(f"Giving up mirroring text batch after repeated FloodWait: {e}")
+        return [None] * len(bot_messages)
     except Exception as e:
-        logger.error(f"Error mirroring message: {e}")
-        return None
+        logger.error(f"Error mirroring text batch: {e}")
+        return [None] * len(bot_messages)
+
+
+def _sent_message_id(request, result) -> Optional[int]:
+    """Extract the new message ID from a raw SendMessageRequest result."""
+    if isinstance(result, UpdateShortSentMessage):
+        return result.id
+    for update in getattr(result, "updates", []):
+        if isinstance(update, UpdateMessageID) and update.random_id == request.random_id:
+            return update.id
+    return None
+
+
+def _batch_key(message: Message) -> Optional[str]:
+    """Return the batch a reply can join, or None if it must be sent alone."""
+    msg_type = get_media_type(message)
+    if msg_type in ALBUM_MEDIA_TYPES:
+        return "album"
+    if msg_type == "text":
+        return "text"
+    return None
+
+
+def batch_replies(replies: List[Message]) -> List[List[Message]]:
+    """Group consecutive photo/video replies and consecutive text replies."""
+    batches: List[List[Message]] = []
+    for reply in replies:
+        key = _batch_key(reply)
+        if key and batches:
+            last = batches[-1]
+            if len(last) < BATCH_MAX_ITEMS and _batch_key(last[0]) == key:
+                last.append(reply)
+                continue
+        batches.append([reply])
+    return batches
+
+
+async def mirror_replies(client: TelegramClient, origin_chat_id: int,
+                         replies: List[Message], bot_chat_id: int, origin_entity) -> int:
+    """
+    Mirror collected bot replies to the origin chat and record their
+    mappings with a single storage write.
+    Returns the number of replies mirrored.
+    """
+    entries = []
+    for batch in batch_replies(replies):
+        if len(batch) == 1:
+            sent = await mirror_message(client, origin_entity, batch[0])
+            mirrored_ids = [sent.id if sent else None]
+        elif _batch_key(batch[0]) == "album":
+            mirrored = await mirror_album(client, origin_entity, batch)
+            mirrored_ids = [m.id if m else None for m in mirrored]
+        else:
+            mirrored_ids = await mirror_text_run(client, origin_entity, batch)
+        
+        for bot_message, mirrored_id in zip(batch, mirrored_ids):
+            if mirrored_id is None:
+                continue
+            entries.append((
+                bot_chat_id, bot_message.id, origin_chat_id, mirrored_id,
+                get_media_type(bot_message), get_content_hash(bot_message)
+            ))
+            logger.info(f"Mirrored msg {bot_message.id} -> {mirrored_id} in chat {origin_chat_id}")
+    
+    await MappingsStorage.add_mappings_bulk(entries)
+    return len(entries)
+
+
+def prune_edit_debounce(max_age: float) -> int:
+    """Drop edit debounce entries older than max_age seconds."""
+    cutoff = time.time() - max_age
+    stale = [k for k, ts in _edit_debounce.items() if ts < cutoff]
+    for k in stale:
+        del _edit_debounce[k]
+    return len(stale)
 
 
 async def handle_edit(client: TelegramClient, edited_message: Message, 
@@ -232,24 +390,21 @@ async def handle_edit(client: TelegramClient, edited_message: Message,
         origin_chat_id = mapping["origin_chat_id"]
         mirrored_msg_id = mapping["mirrored_msg_id"]
         
-        try:
-            origin_entity = await client.get_entity(origin_chat_id)
-        except Exception:
-            origin_entity = await client.get_input_entity(origin_chat_id)
+        origin_entity = await get_cached_entity(client, origin_chat_id, allow_input=True)
         
         if is_media_message(edited_message):
             if mapping.get("type") in ["photo", "video", "document", "voice", "audio"]:
-                await client.edit_message(
+                await with_flood_retry(lambda: client.edit_message(
                     origin_entity,
                     mirrored_msg_id,
                     text=edited_message.message or ""
-                )
+                ), "on edit")
             else:
-                new_mirrored = await client.send_file(
+                new_mirrored = await with_flood_retry(lambda: client.send_file(
                     origin_entity,
                     edited_message.media,
                     caption=f"(updated media)\n{edited_message.message or ''}"
-                )
+                ), "on edit")
                 await MappingsStorage.update_mapping(
                     bot_chat_id=bot_chat_id,
                     bot_msg_id=edited_message.id,
@@ -258,23 +413,45 @@ async def handle_edit(client: TelegramClient, edited_message: Message,
                     new_type=get_media_type(edited_message)
                 )
         else:
-            await client.edit_message(
+            await with_flood_retry(lambda: client.edit_message(
                 origin_entity,
                 mirrored_msg_id,
                 text=edited_message.text or edited_message.message
-            )
+            ), "on edit")
         
         await MappingsStorage.update_hash(bot_chat_id, edited_message.id, new_hash)
         logger.info(f"Edited mirrored message {mirrored_msg_id}")
         
     except FloodWaitError as e:
-        logger.warning(f"FloodWait on edit: {e.seconds}s")
-        await asyncio.sleep(e.seconds)
-        await handle_edit(client, edited_message, bot_chat_id, debounce_seconds)
+        logger.error(f"Giving up edit after repeated FloodWait: {e}")
+    except PeerIdInvalidError as e:
+        invalidate_entity(mapping["origin_chat_id"])
+        logger.error(f"Invalid peer editing mirrored message, entity cache cleared: {e}")
     except Exception as e:
         logger.error(f"Error handling edit: {e}")
 
 
+async def _resolve_origin(client: TelegramClient, origin_chat_id: int, origin_entity=None):
+    """Resolve the origin chat, falling back to the raw chat ID."""
+    if origin_entity is not None:
+        return origin_entity
+    try:
+        return await get_cached_entity(client, origin_chat_id, allow_input=True)
+    except Exception:
+        return origin_chat_id
+
+
+async def _resolve_bot(client: TelegramClient, target_bot: Optional[str]):
+    """Resolve the target bot entity, or None if unset or unresolvable."""
+    if not target_bot:
+        return None
+    try:
+        return await get_cached_entity(client, target_bot)
+    except Exception as e:
+        logger.error(f"Could not get bot entity: {e}")
+        return None
+
+
 async def process_relay_request(client: TelegramClient, origin_message: Message,
                                 origin_chat_id: int, origin_entity=None) -> bool:
     """
@@ -284,16 +461,14 @@ async def process_relay_request(client: TelegramClient, origin_message: Message,
     3. Collect replies
     4. Mirror replies to origin
     """
-    if origin_entity is None:
-        try:
-            origin_entity = await client.get_entity(origin_chat_id)
-        except Exception:
-            try:
-                origin_entity = await client.get_input_entity(origin_chat_id)
-            except Exception:
-                origin_entity = origin_chat_id
-    
     target_bot = await ConfigStorage.get_chat_bot(origin_chat_id)
+    
+    # The origin and bot lookups are independent, so resolve them concurrently
+    origin_entity, bot_entity = await asyncio.gather(
+        _resolve_origin(client, origin_chat_id, origin_entity),
+        _resolve_bot(client, target_bot)
+    )
+    
     if not target_bot:
         await client.send_message(
             origin_entity,
@@ -301,36 +476,46 @@ async def process_relay_request(client: TelegramClient, origin_message: Message,
         )
         return False
     
-    settings = await ConfigStorage.get_settings()
-    
-    sent = await relay_message(client, origin_message, target_bot)
-    if not sent:
+    if bot_entity is None:
         await client.send_message(origin_entity, "Failed to relay message to bot.")
         return False
+    bot_chat_id = bot_entity.id
     
-    try:
-        bot_entity = await client.get_entity(target_bot)
-        bot_chat_id = bot_entity.id
-    except Exception as e:
-        logger.error(f"Could not get bot entity: {e}")
-        return False
+    settings = await ConfigStorage.get_settings()
     
-    import uuid
-    request_id = str(uuid.uuid4())[:8]
-    await RequestsStorage.add_request(
-        origin_chat_id=origin_chat_id,
-        bot_chat_id=bot_chat_id,
-        sent_to_bot_msg_id=sent.id,
-        request_id=request_id
-    )
+    # Register before sending so fast replies are not missed
+    reply_queue: asyncio.Queue = asyncio.Queue()
+    
+    async def on_bot_reply(event):
+        reply_queue.put_nowait(event.message)
     
-    replies = await collect_bot_replies(client, bot_entity, sent.id, settings)
+    # Only the private chat with the bot; its messages in shared groups aren't replies
+    client.add_event_handler(
+        on_bot_reply, events.NewMessage(chats=bot_entity, incoming=True)
+    )
+    try:
+        sent = await relay_message(client, origin_message, target_bot)
+        if not sent:
+            await client.send_message(origin_entity, "Failed to relay message to bot.")
+            return False
+        
+        import uuid
+        request_id = str(uuid.uuid4())[:8]
+        await RequestsStorage.add_request(
+            origin_chat_id=origin_chat_id,
+            bot_chat_id=bot_chat_id,
+            sent_to_bot_msg_id=sent.id,
+            request_id=request_id
+        )
+        
+        replies = await collect_bot_replies(reply_queue, sent.id, settings)
+    finally:
+        client.remove_event_handler(on_bot_reply)
     
     if not replies:
         await client.send_message(origin_entity, "No response from bot (timeout).")
     else:
-        for reply in replies:
-            await mirror_message(client, origin_chat_id, reply, bot_chat_id, origin_entity)
+        await mirror_replies(client, origin_chat_id, replies, bot_chat_id, origin_entity)
     
     await RequestsStorage.remove_request(origin_chat_id)
     return True
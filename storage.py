@@ -3,75 +3,242 @@ JSON-based storage layer with atomic writes and asyncio locking.
 Handles config, mappings, and active requests persistence.
 """
 import os
-import json
+import copy
 import asyncio
 import time
 import tempfile
 import logging
+from collections import deque
 from datetime import datetime
-from typing import Any, Optional
-import aiofiles
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Optional
+import orjson
 
 from config import (
-    DATA_DIR, CONFIG_FILE, MAPPINGS_FILE, REQUESTS_FILE,
+    DATA_DIR, CONFIG_FILE, MAPPINGS_FILE, MAPPINGS_LOG_FILE, REQUESTS_FILE,
     OWNER_ID, TIMEOUT_SECONDS, REPLY_IDLE_SECONDS, 
-    EDIT_DEBOUNCE_SECONDS, CLEANUP_HOURS
+    EDIT_DEBOUNCE_SECONDS, CLEANUP_HOURS, MAPPINGS_FLUSH_SECONDS,
+    MAPPINGS_LOG_MAX_RECORDS, DURABLE_WRITES, REQUESTS_FLUSH_SECONDS,
+    CONFIG_FLUSH_SECONDS, FLUSH_RETRY_MAX_SECONDS
 )
 
 logger = logging.getLogger(__name__)
 
+# Only guard the first load from disk; once cached, reads are lock-free and
+# mutations happen between awaits, so they are atomic on the event loop
 _config_lock = asyncio.Lock()
 _mappings_lock = asyncio.Lock()
 _requests_lock = asyncio.Lock()
 
+# Serialize file replacement separately so readers never wait on disk writes
+_config_write_lock = asyncio.Lock()
+_mappings_write_lock = asyncio.Lock()
+_requests_write_lock = asyncio.Lock()
+
+# Last payload written per file, so unchanged saves can be skipped
+_last_written: dict = {}
+
 
 def _ensure_data_dir():
     """Ensure data directory exists."""
     os.makedirs(DATA_DIR, exist_ok=True)
 
 
-async def _atomic_write(filepath: str, data: dict):
-    """Write data to file atomically using temp file + rename."""
+def _json_default(obj: Any) -> Any:
+    """orjson fallback for types it can't serialize natively."""
+    if isinstance(obj, ActiveRequest):
+        return obj.to_dict()
+    return str(obj)
+
+
+def _dumps(data: dict) -> bytes:
+    """Serialize data to indented JSON bytes."""
+    return orjson.dumps(
+        data,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS,
+        default=_json_default
+    )
+
+
+def _sync_fsync_dir(dirpath: str):
+    """Flush directory entries (e.g. a rename) to disk."""
+    dir_fd = os.open(dirpath, os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def _sync_write_fd(fd: int, payload: bytes, durable: bool):
+    """Write all of payload to fd unbuffered, then optionally fsync, and close it."""
+    try:
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+        if durable:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _sync_create_write(filepath: str, payload: bytes, durable: bool) -> bool:
+    """
+    Write payload straight into filepath if it doesn't exist yet.
+    Returns False if the file already exists and must be replaced instead.
+    """
+    try:
+        fd = os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    try:
+        _sync_write_fd(fd, payload, durable)
+    except Exception:
+        # Don't leave a partial file that later reads would treat as corrupt
+        os.unlink(filepath)
+        raise
+    if durable:
+        _sync_fsync_dir(DATA_DIR)
+    return True
+
+
+def _sync_atomic_write(filepath: str, payload: bytes, durable: bool):
+    """
+    Write payload via temp file + rename. Runs in a worker thread.
+    Every syscall of a save happens here, so a save costs one thread hop.
+    """
     _ensure_data_dir()
+    # Nothing to replace on first write, so skip the temp file and rename
+    if _sync_create_write(filepath, payload, durable):
+        return
     temp_fd, temp_path = tempfile.mkstemp(dir=DATA_DIR, suffix=".tmp")
     try:
-        os.close(temp_fd)
-        async with aiofiles.open(temp_path, 'w') as f:
-            await f.write(json.dumps(data, indent=2, default=str))
+        # fsync in here: without it a crash can leave an empty file behind the rename
+        _sync_write_fd(temp_fd, payload, durable)
         os.replace(temp_path, filepath)
-    except Exception as e:
+    except Exception:
         if os.path.exists(temp_path):
             os.unlink(temp_path)
-        raise e
+        raise
+    if durable:
+        _sync_fsync_dir(DATA_DIR)
+
+
+def _sync_append(filepath: str, payload: bytes, durable: bool):
+    """Append payload to a file. Runs in a worker thread."""
+    _ensure_data_dir()
+    fd = os.open(filepath, os.O_CREAT | os.O_APPEND | os.O_WRONLY, 0o644)
+    _sync_write_fd(fd, payload, durable)
+
 
+def _sync_compact(snapshot_path: str, log_path: str, payload: bytes, durable: bool):
+    """Replace the snapshot, then empty its append log. Runs in a worker thread."""
+    _sync_atomic_write(snapshot_path, payload, durable)
+    fd = os.open(log_path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o644)
+    _sync_write_fd(fd, b"", durable)
 
-async def _read_json(filepath: str, default: dict) -> dict:
-    """Read JSON file or return default if not exists/corrupt."""
-    if not os.path.exists(filepath):
-        return default.copy()
+
+def _sync_read(filepath: str) -> Optional[bytes]:
+    """Read a whole file, or None if it doesn't exist. Runs in a worker thread."""
     try:
-        async with aiofiles.open(filepath, 'r') as f:
-            content = await f.read()
-            return json.loads(content) if content.strip() else default.copy()
-    except (json.JSONDecodeError, Exception) as e:
+        with open(filepath, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+async def _atomic_write(filepath: str, data: dict, write_lock: asyncio.Lock):
+    """
+    Write data to file atomically using temp file + rename.
+    Data is serialized before waiting on write_lock, so the bytes are a
+    snapshot and callers don't need to hold their cache lock.
+    """
+    payload = _dumps(data)
+    async with write_lock:
+        if _last_written.get(filepath) == payload:
+            return
+        await asyncio.to_thread(_sync_atomic_write, filepath, payload, DURABLE_WRITES)
+        _last_written[filepath] = payload
+
+
+def _schedule_flush(storage: type, delay: float):
+    """Mark a storage class dirty and start its debounced flusher if idle."""
+    storage._dirty = True
+    storage._version += 1
+    if storage._flush_task is None or storage._flush_task.done():
+        storage._flush_task = asyncio.create_task(_flush_later(storage, delay))
+
+
+async def _flush_later(storage: type, delay: float):
+    """Flush after delay, repeating while changes keep arriving and retrying failures with backoff."""
+    wait = delay
+    while storage._dirty:
+        await asyncio.sleep(wait)
+        try:
+            await storage.flush_now()
+            wait = delay
+        except Exception as e:
+            wait = min(wait * 2, FLUSH_RETRY_MAX_SECONDS)
+            logger.error(f"Error flushing {storage.__name__}: {e}, retrying in {wait:g}s")
+
+
+async def _run_flush(storage: type, write: Callable[[], Awaitable[None]]):
+    """
+    Run write() for a dirty storage class, one flush at a time.
+    Only clears the dirty flag once the write succeeds with no newer changes;
+    then a flusher that hasn't started writing is cancelled. After a failure
+    it is left running so it can retry.
+    """
+    async with storage._flush_lock:
+        if not storage._dirty:
+            return
+        version = storage._version
+        await write()
+        if storage._version != version:
+            return
+        storage._dirty = False
+        task = storage._flush_task
+        if task is not None and task is not asyncio.current_task() and not task.done():
+            # We hold the flush lock, so it's sleeping or waiting on it, never mid-write
+            task.cancel()
+            storage._flush_task = None
+
+
+async def _read_json(filepath: str, default_factory: Callable[[], dict]) -> dict:
+    """Read JSON file, or build a default with default_factory if not exists/corrupt."""
+    try:
+        content = await asyncio.to_thread(_sync_read, filepath)
+        if content is None or not content.strip():
+            return default_factory()
+        return orjson.loads(content)
+    except Exception as e:
         logger.warning(f"Error reading {filepath}: {e}, using defaults")
-        return default.copy()
+        return default_factory()
+
+
+# Read-only templates; callers get deep copies so nested containers are never shared
+_DEFAULT_SETTINGS = MappingProxyType({
+    "timeout": TIMEOUT_SECONDS,
+    "reply_idle": REPLY_IDLE_SECONDS,
+    "edit_debounce": EDIT_DEBOUNCE_SECONDS,
+    "cleanup_hours": CLEANUP_HOURS
+})
+
+_DEFAULT_CONFIG = MappingProxyType({
+    "global_bot": None,
+    "chat_bots": {},
+    "owner_id": OWNER_ID,
+    "allowed_users": [OWNER_ID] if OWNER_ID else [],
+    "settings": dict(_DEFAULT_SETTINGS)
+})
+
+_DEFAULT_REQUESTS = MappingProxyType({
+    "active_requests": {}
+})
 
 
 def _get_default_config() -> dict:
     """Return default configuration structure."""
-    return {
-        "global_bot": None,
-        "chat_bots": {},
-        "owner_id": OWNER_ID,
-        "allowed_users": [OWNER_ID] if OWNER_ID else [],
-        "settings": {
-            "timeout": TIMEOUT_SECONDS,
-            "reply_idle": REPLY_IDLE_SECONDS,
-            "edit_debounce": EDIT_DEBOUNCE_SECONDS,
-            "cleanup_hours": CLEANUP_HOURS
-        }
-    }
+    return copy.deepcopy(dict(_DEFAULT_CONFIG))
 
 
 def _get_default_mappings() -> dict:
@@ -82,36 +249,114 @@ def _get_default_mappings() -> dict:
     }
 
 
-def _get_default_requests() -> dict:
-    """Return default requests structure."""
+def _new_mapping(bot_chat_id: int, bot_msg_id: int, origin_chat_id: int,
+                 mirrored_msg_id: int, msg_type: str = "text",
+                 content_hash: str = "") -> dict:
+    """Build a mapping record."""
     return {
-        "active_requests": {}
+        "ts": int(time.time()),
+        "bot_chat_id": bot_chat_id,
+        "bot_msg_id": bot_msg_id,
+        "origin_chat_id": origin_chat_id,
+        "mirrored_msg_id": mirrored_msg_id,
+        "type": msg_type,
+        "last_hash": content_hash
     }
 
 
+class ActiveRequest:
+    """An in-flight relay request; stored as a plain dict in requests.json."""
+    
+    __slots__ = ("request_id", "bot_chat_id", "sent_to_bot_msg_id", "started_ts")
+    
+    def __init__(self, request_id: str, bot_chat_id: int,
+                 sent_to_bot_msg_id: int, started_ts: int):
+        self.request_id = request_id
+        self.bot_chat_id = bot_chat_id
+        self.sent_to_bot_msg_id = sent_to_bot_msg_id
+        self.started_ts = started_ts
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> "ActiveRequest":
+        """Rehydrate a record loaded from requests.json."""
+        return cls(
+            data.get("request_id"),
+            data.get("bot_chat_id"),
+            data.get("sent_to_bot_msg_id"),
+            data.get("started_ts", 0)
+        )
+    
+    def to_dict(self) -> dict:
+        """Return the on-disk representation."""
+        return {
+            "request_id": self.request_id,
+            "bot_chat_id": self.bot_chat_id,
+            "sent_to_bot_msg_id": self.sent_to_bot_msg_id,
+            "started_ts": self.started_ts
+        }
+
+
+def _get_default_requests() -> dict:
+    """Return default requests structure."""
+    return copy.deepcopy(dict(_DEFAULT_REQUESTS))
+
+
 class ConfigStorage:
-    """Handles configuration storage (global bot, per-chat bots, allowed users)."""
+    """
+    Handles configuration storage (global bot, per-chat bots, allowed users).
+    The cached config is treated as an immutable snapshot: writers build a
+    new dict and swap it in, so readers never need a lock.
+    """
     
     _cache: Optional[dict] = None
+    _allowed_set: frozenset = frozenset()
+    _dirty: bool = False
+    _version: int = 0
+    _flush_task: Optional[asyncio.Task] = None
+    _flush_lock = asyncio.Lock()
+    
+    @classmethod
+    def _set_cache(cls, config: dict):
+        """Install a new config snapshot and its derived lookups."""
+        cls._allowed_set = frozenset(config.get("allowed_users", []))
+        cls._cache = config
     
     @classmethod
     async def load(cls) -> dict:
         """Load config from file or cache."""
+        # Hot path: once loaded, reads skip the lock entirely
+        if cls._cache is not None:
+            return cls._cache
         async with _config_lock:
             if cls._cache is None:
-                cls._cache = await _read_json(CONFIG_FILE, _get_default_config())
-                if cls._cache.get("owner_id") == 0 and OWNER_ID:
-                    cls._cache["owner_id"] = OWNER_ID
-                if OWNER_ID and OWNER_ID not in cls._cache.get("allowed_users", []):
-                    cls._cache.setdefault("allowed_users", []).append(OWNER_ID)
+                config = await _read_json(CONFIG_FILE, _get_default_config)
+                if config.get("owner_id") == 0 and OWNER_ID:
+                    config["owner_id"] = OWNER_ID
+                allowed = config.setdefault("allowed_users", [])
+                if OWNER_ID and OWNER_ID not in allowed:
+                    allowed.append(OWNER_ID)
+                cls._set_cache(config)
             return cls._cache
     
     @classmethod
     async def save(cls):
         """Save current cache to file."""
-        async with _config_lock:
-            if cls._cache:
-                await _atomic_write(CONFIG_FILE, cls._cache)
+        if cls._cache:
+            await _atomic_write(CONFIG_FILE, cls._cache, _config_write_lock)
+    
+    @classmethod
+    async def flush_now(cls):
+        """Write pending config changes immediately (e.g. on shutdown)."""
+        await _run_flush(cls, cls.save)
+    
+    @classmethod
+    async def _update(cls, **changes):
+        """Swap in a new config snapshot with changes applied, and schedule a save."""
+        config = await cls.load()
+        if all(config.get(k) == v for k, v in changes.items()):
+            return
+        cls._set_cache({**config, **changes})
+        _schedule_flush(cls, CONFIG_FLUSH_SECONDS)
     
     @classmethod
     async def get_global_bot(cls) -> Optional[str]:
@@ -122,9 +367,7 @@ class ConfigStorage:
     @classmethod
     async def set_global_bot(cls, bot_username: str):
         """Set global default bot username."""
-        config = await cls.load()
-        config["global_bot"] = bot_username
-        await cls.save()
+        await cls._update(global_bot=bot_username)
     
     @classmethod
     async def get_chat_bot(cls, chat_id: int) -> Optional[str]:
@@ -138,8 +381,12 @@ class ConfigStorage:
     async def set_chat_bot(cls, chat_id: int, bot_username: str):
         """Set bot for specific chat."""
         config = await cls.load()
-        config.setdefault("chat_bots", {})[str(chat_id)] = bot_username
-        await cls.save()
+        chat_bots = config.get("chat_bots", {})
+        chat_id_str = str(chat_id)
+        if chat_bots.get(chat_id_str) == bot_username:
+            return
+        chat_bots = {**chat_bots, chat_id_str: bot_username}
+        await cls._update(chat_bots=chat_bots)
     
     @classmethod
     async def get_allowed_users(cls) -> list:
@@ -154,15 +401,15 @@ class ConfigStorage:
         owner = config.get("owner_id", OWNER_ID)
         if user_id == owner:
             return True
-        return user_id in config.get("allowed_users", [])
+        return user_id in cls._allowed_set
     
     @classmethod
     async def allow_user(cls, user_id: int):
         """Add user to allowed list."""
         config = await cls.load()
-        if user_id not in config.setdefault("allowed_users", []):
-            config["allowed_users"].append(user_id)
-            await cls.save()
+        allowed = config.get("allowed_users", [])
+        if user_id not in allowed:
+            await cls._update(allowed_users=[*allowed, user_id])
     
     @classmethod
     async def disallow_user(cls, user_id: int):
@@ -173,8 +420,7 @@ class ConfigStorage:
             return False
         allowed = config.get("allowed_users", [])
         if user_id in allowed:
-            allowed.remove(user_id)
-            await cls.save()
+            await cls._update(allowed_users=[uid for uid in allowed if uid != user_id])
             return True
         return False
     
@@ -188,98 +434,236 @@ class ConfigStorage:
     async def get_settings(cls) -> dict:
         """Get settings dict."""
         config = await cls.load()
-        return config.get("settings", {
-            "timeout": TIMEOUT_SECONDS,
-            "reply_idle": REPLY_IDLE_SECONDS,
-            "edit_debounce": EDIT_DEBOUNCE_SECONDS,
-            "cleanup_hours": CLEANUP_HOURS
-        })
+        return config.get("settings") or dict(_DEFAULT_SETTINGS)
 
 
 class MappingsStorage:
-    """Handles message mappings for edit mirroring."""
+    """
+    Handles message mappings for edit mirroring.
+    Changes are appended to a JSONL log; the JSON snapshot is only
+    rewritten when the log is compacted.
+    """
     
     _cache: Optional[dict] = None
+    _index: dict = {}
+    # (ts, key) in time order; entries go stale when a mapping's ts changes
+    _expiry: deque = deque()
+    _pending: dict = {}
+    _log_records: int = 0
+    # Set when a snapshot rewrite failed and must be retried (e.g. after cleanup)
+    _needs_compaction: bool = False
+    _dirty: bool = False
+    _version: int = 0
+    _flush_task: Optional[asyncio.Task] = None
+    _flush_lock = asyncio.Lock()
     
     @classmethod
     async def load(cls) -> dict:
-        """Load mappings from file or cache."""
+        """Load mappings from the snapshot plus the append log, or cache."""
+        if cls._cache is not None:
+            return cls._cache
         async with _mappings_lock:
             if cls._cache is None:
-                cls._cache = await _read_json(MAPPINGS_FILE, _get_default_mappings())
+                cache = await _read_json(MAPPINGS_FILE, _get_default_mappings)
+                cls._reindex(cache.setdefault("mappings", []))
+                log = await asyncio.to_thread(_sync_read, MAPPINGS_LOG_FILE)
+                if log:
+                    cls._replay_log(log)
+                # Publish last: the lock-free fast path must never see a partial index
+                cls._cache = cache
             return cls._cache
     
+    @classmethod
+    def _replay_log(cls, log: bytes):
+        """Apply logged mapping records on top of the loaded snapshot."""
+        count = 0
+        for line in log.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = orjson.loads(line)
+                key = (record["bot_chat_id"], record["bot_msg_id"])
+                ts = record["ts"]
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                logger.warning("Skipping corrupt record in mappings log")
+                continue
+            existing = cls._index.get(key)
+            if existing is not None:
+                existing.update(record)
+                cls._expiry.append((ts, key))
+            else:
+                cls._append(record)
+            count += 1
+        cls._log_records = count
+        if not log.endswith(b"\n"):
+            # A torn last append; the next append would be glued onto it, so compact instead
+            logger.warning("Mappings log ends with a partial record, will compact")
+            cls._needs_compaction = True
+    
+    @classmethod
+    def _reindex(cls, mappings: list):
+        """Rebuild the (bot_chat_id, bot_msg_id) lookup index and expiry queue."""
+        cls._index = {(m["bot_chat_id"], m["bot_msg_id"]): m for m in mappings}
+        cls._expiry = deque(sorted((m.get("ts", 0), key) for key, m in cls._index.items()))
+    
+    @classmethod
+    def _append(cls, mapping: dict):
+        """
+        Add a mapping to the index.
+        The index is the source of truth; the cached list is rebuilt from it on save.
+        """
+        key = (mapping["bot_chat_id"], mapping["bot_msg_id"])
+        cls._index[key] = mapping
+        cls._expiry.append((mapping["ts"], key))
+    
     @classmethod
     async def save(cls):
-        """Save mappings to file immediately (for crash safety)."""
-        async with _mappings_lock:
-            if cls._cache:
-                await _atomic_write(MAPPINGS_FILE, cls._cache)
+        """Write a full snapshot immediately and truncate the append log."""
+        if not cls._cache:
+            return
+        cls._cache["mappings"] = list(cls._index.values())
+        payload = _dumps(cls._cache)
+        # The snapshot covers everything pending so far; later changes stay pending
+        covered = cls._take_pending()
+        try:
+            async with _mappings_write_lock:
+                await asyncio.to_thread(
+                    _sync_compact, MAPPINGS_FILE, MAPPINGS_LOG_FILE, payload, DURABLE_WRITES
+                )
+        except Exception:
+            cls._restore_pending(covered)
+            cls._needs_compaction = True
+            raise
+        cls._needs_compaction = False
+        cls._log_records = 0
+    
+    @classmethod
+    async def _append_log(cls):
+        """Append pending mappings to the log, one JSON record per line."""
+        records = cls._take_pending()
+        payload = b"".join(orjson.dumps(m, default=str) + b"\n" for m in records.values())
+        try:
+            async with _mappings_write_lock:
+                await asyncio.to_thread(_sync_append, MAPPINGS_LOG_FILE, payload, DURABLE_WRITES)
+        except Exception:
+            cls._restore_pending(records)
+            raise
+        cls._log_records += len(records)
+    
+    @classmethod
+    def _take_pending(cls) -> dict:
+        """Detach the pending records so changes made during a write are kept apart."""
+        records = cls._pending
+        cls._pending = {}
+        return records
+    
+    @classmethod
+    def _restore_pending(cls, records: dict):
+        """Put records back after a failed write, without clobbering newer changes."""
+        for key, m in records.items():
+            cls._pending.setdefault(key, m)
+    
+    @classmethod
+    def _mark_dirty(cls, mapping: dict):
+        """Record a changed mapping and schedule a debounced flush."""
+        cls._pending[(mapping["bot_chat_id"], mapping["bot_msg_id"])] = mapping
+        _schedule_flush(cls, MAPPINGS_FLUSH_SECONDS)
+    
+    @classmethod
+    async def flush_now(cls):
+        """Write pending mapping changes immediately (e.g. on shutdown)."""
+        await _run_flush(cls, cls._write_pending)
+    
+    @classmethod
+    async def _write_pending(cls):
+        """Append pending changes to the log, or compact once it grows too long."""
+        if (cls._needs_compaction
+                or cls._log_records + len(cls._pending) > MAPPINGS_LOG_MAX_RECORDS):
+            await cls.save()
+        else:
+            await cls._append_log()
     
     @classmethod
     async def add_mapping(cls, bot_chat_id: int, bot_msg_id: int, 
                           origin_chat_id: int, mirrored_msg_id: int,
                           msg_type: str = "text", content_hash: str = ""):
         """Add a new message mapping."""
-        data = await cls.load()
-        mapping = {
-            "ts": int(time.time()),
-            "bot_chat_id": bot_chat_id,
-            "bot_msg_id": bot_msg_id,
-            "origin_chat_id": origin_chat_id,
-            "mirrored_msg_id": mirrored_msg_id,
-            "type": msg_type,
-            "last_hash": content_hash
-        }
-        data["mappings"].append(mapping)
-        await cls.save()
+        await cls.load()
+        mapping = _new_mapping(
+            bot_chat_id, bot_msg_id, origin_chat_id,
+            mirrored_msg_id, msg_type, content_hash
+        )
+        cls._append(mapping)
+        cls._mark_dirty(mapping)
+    
+    @classmethod
+    async def add_mappings_bulk(cls, entries: list):
+        """
+        Add several mappings in one call.
+        Each entry is a (bot_chat_id, bot_msg_id, origin_chat_id,
+        mirrored_msg_id, msg_type, content_hash) tuple.
+        """
+        if not entries:
+            return
+        await cls.load()
+        for entry in entries:
+            mapping = _new_mapping(*entry)
+            cls._append(mapping)
+            cls._mark_dirty(mapping)
     
     @classmethod
     async def get_mapping(cls, bot_chat_id: int, bot_msg_id: int) -> Optional[dict]:
         """Get mapping by bot message info."""
-        data = await cls.load()
-        for m in data.get("mappings", []):
-            if m["bot_chat_id"] == bot_chat_id and m["bot_msg_id"] == bot_msg_id:
-                return m
-        return None
+        await cls.load()
+        return cls._index.get((bot_chat_id, bot_msg_id))
     
     @classmethod
     async def update_hash(cls, bot_chat_id: int, bot_msg_id: int, new_hash: str):
         """Update the content hash for a mapping."""
-        data = await cls.load()
-        for m in data.get("mappings", []):
-            if m["bot_chat_id"] == bot_chat_id and m["bot_msg_id"] == bot_msg_id:
-                m["last_hash"] = new_hash
-                await cls.save()
-                return
+        await cls.load()
+        m = cls._index.get((bot_chat_id, bot_msg_id))
+        if m:
+            m["last_hash"] = new_hash
+            cls._mark_dirty(m)
     
     @classmethod
     async def update_mapping(cls, bot_chat_id: int, bot_msg_id: int, 
                              new_mirrored_msg_id: int, new_hash: str, new_type: str = None):
         """Update an existing mapping with new mirrored message info (for media replacement)."""
-        data = await cls.load()
-        for m in data.get("mappings", []):
-            if m["bot_chat_id"] == bot_chat_id and m["bot_msg_id"] == bot_msg_id:
-                m["mirrored_msg_id"] = new_mirrored_msg_id
-                m["last_hash"] = new_hash
-                m["ts"] = int(time.time())
-                if new_type:
-                    m["type"] = new_type
-                await cls.save()
-                return True
-        return False
+        await cls.load()
+        m = cls._index.get((bot_chat_id, bot_msg_id))
+        if not m:
+            return False
+        m["mirrored_msg_id"] = new_mirrored_msg_id
+        m["last_hash"] = new_hash
+        m["ts"] = int(time.time())
+        cls._expiry.append((m["ts"], (bot_chat_id, bot_msg_id)))
+        if new_type:
+            m["type"] = new_type
+        cls._mark_dirty(m)
+        return True
     
     @classmethod
     async def cleanup_old(cls, hours: int):
         """Remove mappings older than specified hours."""
-        data = await cls.load()
+        await cls.load()
         cutoff = int(time.time()) - (hours * 3600)
-        original_count = len(data.get("mappings", []))
-        data["mappings"] = [m for m in data.get("mappings", []) if m.get("ts", 0) > cutoff]
-        removed = original_count - len(data["mappings"])
+        removed = 0
+        queue = cls._expiry
+        while queue and queue[0][0] <= cutoff:
+            ts, key = queue.popleft()
+            m = cls._index.get(key)
+            # Skip entries superseded by a later ts for the same mapping
+            if m is not None and m.get("ts", 0) == ts:
+                del cls._index[key]
+                removed += 1
         if removed > 0:
             logger.info(f"Cleaned up {removed} old mappings")
-            await cls.save()
+            # Compact so removed mappings aren't replayed from the log. Going through
+            # flush_now keeps this from interleaving with a flusher's log append
+            cls._needs_compaction = True
+            _schedule_flush(cls, MAPPINGS_FLUSH_SECONDS)
+            await cls.flush_now()
         return removed
 
 
@@ -287,58 +671,89 @@ class RequestsStorage:
     """Handles active relay request tracking."""
     
     _cache: Optional[dict] = None
+    # (started_ts, key) in time order; entries go stale when a request is replaced or removed
+    _expiry: deque = deque()
+    _dirty: bool = False
+    _version: int = 0
+    _flush_task: Optional[asyncio.Task] = None
+    _flush_lock = asyncio.Lock()
     
     @classmethod
     async def load(cls) -> dict:
         """Load requests from file or cache."""
+        if cls._cache is not None:
+            return cls._cache
         async with _requests_lock:
             if cls._cache is None:
-                cls._cache = await _read_json(REQUESTS_FILE, _get_default_requests())
+                cache = await _read_json(REQUESTS_FILE, _get_default_requests)
+                active = {
+                    k: ActiveRequest.from_dict(v)
+                    for k, v in cache.get("active_requests", {}).items()
+                }
+                cache["active_requests"] = active
+                cls._expiry = deque(sorted((r.started_ts, k) for k, r in active.items()))
+                cls._cache = cache
             return cls._cache
     
     @classmethod
     async def save(cls):
         """Save requests to file."""
-        async with _requests_lock:
-            if cls._cache:
-                await _atomic_write(REQUESTS_FILE, cls._cache)
+        if cls._cache:
+            await _atomic_write(REQUESTS_FILE, cls._cache, _requests_write_lock)
+    
+    @classmethod
+    def _mark_dirty(cls):
+        """Schedule a debounced save so requests finishing together share one write."""
+        _schedule_flush(cls, REQUESTS_FLUSH_SECONDS)
+    
+    @classmethod
+    async def flush_now(cls):
+        """Write pending request changes immediately (e.g. on shutdown)."""
+        await _run_flush(cls, cls.save)
     
     @classmethod
     async def add_request(cls, origin_chat_id: int, bot_chat_id: int, 
                           sent_to_bot_msg_id: int, request_id: str):
         """Track a new relay request."""
         data = await cls.load()
-        data["active_requests"][str(origin_chat_id)] = {
-            "request_id": request_id,
-            "bot_chat_id": bot_chat_id,
-            "sent_to_bot_msg_id": sent_to_bot_msg_id,
-            "started_ts": int(time.time())
-        }
-        await cls.save()
+        now = int(time.time())
+        key = str(origin_chat_id)
+        data["active_requests"][key] = ActiveRequest(
+            request_id, bot_chat_id, sent_to_bot_msg_id, now
+        )
+        cls._expiry.append((now, key))
+        cls._mark_dirty()
     
     @classmethod
-    async def get_request(cls, origin_chat_id: int) -> Optional[dict]:
+    async def get_request(cls, origin_chat_id: int) -> Optional[ActiveRequest]:
         """Get active request for a chat."""
         data = await cls.load()
-        return data.get("active_requests", {}).get(str(origin_chat_id))
+        return data["active_requests"].get(str(origin_chat_id))
     
     @classmethod
     async def remove_request(cls, origin_chat_id: int):
         """Remove completed request."""
         data = await cls.load()
-        if str(origin_chat_id) in data.get("active_requests", {}):
-            del data["active_requests"][str(origin_chat_id)]
-            await cls.save()
+        active = data["active_requests"]
+        key = str(origin_chat_id)
+        if key in active:
+            del active[key]
+            cls._mark_dirty()
     
     @classmethod
     async def cleanup_stale(cls, timeout_seconds: int):
         """Remove requests older than timeout."""
         data = await cls.load()
         cutoff = int(time.time()) - timeout_seconds
-        stale = [k for k, v in data.get("active_requests", {}).items() 
-                 if v.get("started_ts", 0) < cutoff]
-        for k in stale:
-            del data["active_requests"][k]
-        if stale:
-            logger.info(f"Cleaned up {len(stale)} stale requests")
-            await cls.save()
+        active = data["active_requests"]
+        removed = 0
+        queue = cls._expiry
+        while queue and queue[0][0] < cutoff:
+            ts, key = queue.popleft()
+            request = active.get(key)
+            if request is not None and request.started_ts == ts:
+                del active[key]
+                removed += 1
+        if removed:
+            logger.info(f"Cleaned up {removed} stale requests")
+            cls._mark_dirty()